@@ -4,7 +4,142 @@ import argparse
 import os
 import sys
 from scipy import ndimage as ndi
-from skimage.morphology import binary_dilation
+import cc3d
+import edt
+from concurrent.futures import ThreadPoolExecutor
+# Optional GPU support: with CuPy and cuCIM installed (and a CUDA device), labelling and distance maps run on the GPU
+try:
+    import cupy as cp
+    from cupyx.scipy import ndimage as cndi
+    from cucim.core.operations.morphology import distance_transform_edt as cu_edt
+    GPU_AVAILABLE = cp.cuda.runtime.getDeviceCount() > 0
+except Exception:
+    GPU_AVAILABLE = False
+
+###################################################
+# define functions
+
+def analyzeDiff(diff, reference, voxel_resolution, connectivity, min_size, max_overlap, threads=1, use_gpu=False):
+    '''
+    This function counts the lesions of a difference volume (fu - bl or bl - fu) and classifies them into
+    lesions with a hole (i.e., enlarging/shrinking) and solitary lesions (i.e., new/disappearing).
+
+    :param diff: boolean difference volume
+    :param reference: boolean lesion mask of the timepoint that was subtracted, used for the overlap criterion
+    :param voxel_resolution: voxel resolution along each axis, in mm
+    :param connectivity: connected component connectivity (26 - 18 - 6)
+    :param min_size: minimum lesion size, in mm^3
+    :param max_overlap: maximum overlap between a dilated lesion and the reference lesions (in percentage of its volume)
+    :param threads: number of threads used for the distance map
+    :param use_gpu: label the lesions and compute the distance map on the GPU (needs CuPy and cuCIM)
+    :return: return the label image, the number of lesions, the lesion sizes in mm^3, the candidate lesions,
+             the lesions with a hole, the lesions too small, the overlaps and the solitary lesions
+    '''
+    voxelsize = np.prod(voxel_resolution)
+    if use_gpu:
+        # Same steps as below on the device, only the label image and the per-lesion values are copied back
+        diff_gpu = cp.asarray(diff)
+        structure = ndi.generate_binary_structure(3, {6: 1, 18: 2, 26: 3}[connectivity])
+        lesions_gpu, number_of_lesions = cndi.label(diff_gpu, structure=cp.asarray(structure))
+        lesion_counts = cp.asnumpy(cp.bincount(lesions_gpu.ravel(), minlength=number_of_lesions + 1)[1:])
+        distance_map = cu_edt(diff_gpu, sampling=tuple(voxel_resolution))
+        max_distances = np.zeros(number_of_lesions)
+        if number_of_lesions > 0:
+            max_distances = cp.asnumpy(cndi.maximum(distance_map, labels=lesions_gpu, index=cp.arange(1, number_of_lesions + 1)))
+        lesions = cp.asnumpy(lesions_gpu).astype(np.uint32)
+    else:
+        # First count lesions with connected components
+        lesions, number_of_lesions = cc3d.connected_components(diff, connectivity=connectivity, out_dtype=np.uint32, return_N=True)
+        lesion_counts = np.bincount(lesions.ravel())[1:]  # remove background
+        # Also compute distance_map (euclidean) to decide if the lesion has an acceptable shape
+        # (binary input on purpose: a multilabel edt would also stop at diagonal contacts between components)
+        distance_map = edt.edt(diff, anisotropy=tuple(voxel_resolution), black_border=False, parallel=threads)
+        # Largest distance to the background within each lesion, all lesions at once
+        max_distances = ndi.maximum(distance_map, labels=lesions, index=np.arange(1, number_of_lesions + 1))
+    # Remove lesion that are smaller than min_size
+    lesion_sizes = lesion_counts * voxelsize
+    # First discard lesions that are definitevely smaller than min_size
+    # (avoiding removing ring shape differences which might be smaller than min_size but filled they are not)
+    candidates = lesion_sizes > 0.7 * min_size
+    # Bounding box of each lesion, so that the loop below only touches the voxels around it
+    slices = ndi.find_objects(lesions)
+    # Measure each candidate lesion on its bounding box: its volume once the holes are filled (in voxels)
+    filled_counts = lesion_counts.copy()
+    for lesion_number in np.flatnonzero(candidates) + 1:
+
+        # A hole needs the lesion on both sides of it along every axis, so thin lesions are left as they are
+        if min(s.stop - s.start for s in slices[lesion_number - 1]) < 3:
+            continue
+        # Crop to the bounding box padded by one voxel of background
+        sl = tuple(slice(max(s.start - 1, 0), s.stop + 1) for s in slices[lesion_number - 1])
+        filled_counts[lesion_number - 1] = np.count_nonzero(ndi.binary_fill_holes(lesions[sl] == lesion_number))
+    # And the overlap of each dilated lesion with the reference lesions, all lesions at once
+    overlaps = dilatedOverlaps(lesions, number_of_lesions, reference)
+
+    # Then classify all candidate lesions at once
+    # Check if diff lesion has an hole (i.e., it's enlarging/shrinking)
+    # Right now I'm just taking the diff lesion, fill the holes and check if the enlargment is bigger than (TODO: 5%?) than the filled part
+    # TODO: not sure if it is really necessary to check for this 5% increase, although ...
+    # if we have a mislabeled voxel inside the lesion, we might classify the lesion as enlarging/shrinking rather than something else
+    # Note that I'm also checking if *the filled lesion* fits the min size criteria
+    holes = candidates & (filled_counts - lesion_counts > 0.05 * filled_counts) & (filled_counts > min_size)
+    # Remove lesions that are too small (Assuming same resolution for followup image)
+    too_small = candidates & ~holes & (lesion_sizes <= min_size)
+    # Finally, check if we have a new/disappearing solitary lesion or a lesion abutting from another lesion:
+    # 1) has roughly a spheroid shape
+    # 2) if dilated the overlap with other lesions is small (less than max_overlap of its volume)
+    solitary = candidates & ~holes & ~too_small & (max_distances > 1.1 * voxelsize) & (overlaps < max_overlap * lesion_sizes)
+
+    return lesions, number_of_lesions, lesion_sizes, candidates, holes, too_small, overlaps, solitary
+
+def dilatedOverlaps(lesions, number_of_lesions, reference):
+    '''
+    This function counts, for all lesions at once, the reference voxels covered by each lesion once dilated with
+    the 6-connected cross (i.e., the reference voxels with at least one face neighbour in the lesion).
+    The lesions and the reference mask must not overlap, as is the case for a difference volume.
+
+    :param lesions: label image of the lesions
+    :param number_of_lesions: number of lesions in the label image
+    :param reference: boolean lesion mask of the other timepoint
+    :return: return the overlap of each lesion, in voxels
+    '''
+    # Flat positions of the reference voxels in the zero-padded label image, and labels of their 6 face neighbours
+    # (made C-contiguous once, so the flat view below is not a copy of the whole volume; NIfTI data is Fortran-ordered)
+    padded = np.ascontiguousarray(np.pad(lesions, 1))
+    flat = padded.ravel()
+    positions = np.ravel_multi_index(tuple(index + 1 for index in np.nonzero(reference)), padded.shape)
+    steps = np.cumprod((1,) + padded.shape[:0:-1])[::-1]  # flat offset of one voxel along each axis
+    neighbours = np.stack([flat[positions + sign * step] for step in steps for sign in (-1, 1)], axis=1)
+    # Count a reference voxel once per lesion, even if several of its neighbours belong to that lesion
+    neighbours.sort(axis=1)
+    first = np.ones(neighbours.shape, dtype=bool)
+    first[:, 1:] = neighbours[:, 1:] != neighbours[:, :-1]
+    return np.bincount(neighbours[first], minlength=number_of_lesions + 1)[1:]  # remove background
+
+def printClassification(candidates, lesion_sizes, holes, too_small, overlaps, solitary, holes_label, solitary_label):
+    '''
+    This function prints, lesion by lesion, how the candidate lesions of a difference volume were classified.
+
+    :param holes_label: message printed for lesions with a hole
+    :param solitary_label: message printed for solitary lesions
+    (the other parameters are the outputs of analyzeDiff)
+    '''
+    for lesion_number in np.flatnonzero(candidates) + 1:
+        print("Lesion: " + str(lesion_number))
+        print("Volume [mm^3]: " + str(lesion_sizes[lesion_number - 1]))
+        if holes[lesion_number - 1]:
+            print(holes_label)
+        elif too_small[lesion_number - 1]:
+            print("Remove lesion, too small")
+        else:
+            print("Overlap: " + str(overlaps[lesion_number - 1]))
+            if solitary[lesion_number - 1]:
+                print(solitary_label)
+            else:
+                print("Remove lesion, it doesn't fit criteria")
+
+####################################################
+# main script
 
 parser = argparse.ArgumentParser()
 
@@ -18,193 +153,75 @@ parser.add_argument('--min-size', type=float, default=15.0, help='Minimum voxel
 parser.add_argument('--connectivity', type=int, default=18, help='Connected component connectivity (26 - 18 - 6).')  # 18 as default as in Commowick2018 (MSSeg challenge)
 parser.add_argument('--max-overlap', type=float, default=0.3, help='Maximum overlap between a dilated lesion and another existing lesion to classify it as new/disappearing (in percentage of its volume).')
 parser.add_argument('--debug', action='store_true', default=False, help='Verbose option, useful for debugging.')
+parser.add_argument('--no-gpu', action='store_true', default=False, help='Do not use the GPU, even if CuPy and cuCIM are available.')
 
 args = parser.parse_args()
 
-# Set-up connectivity matrix
-if args.connectivity == 26:
-    connectivity = np.ones([3, 3, 3])
-elif args.connectivity == 18:
-    connectivity = np.ones([3, 3, 3])
-    connectivity[0, 0, 0] = 0
-    connectivity[-1, -1, -1] = 0
-    connectivity[0, -1, -1] = 0
-    connectivity[-1, 0, 0] = 0
-    connectivity[0, 0, -1] = 0
-    connectivity[0, -1, 0] = 0
-    connectivity[-1, 0, -1] = 0
-    connectivity[-1, -1, 0] = 0
-elif args.connectivity == 6:
-    connectivity = np.zeros([3, 3, 3])
-    connectivity[1, 1, 1] = 1
-    connectivity[0, 1, 1] = 1
-    connectivity[2, 1, 1] = 1
-    connectivity[1, 0, 1] = 1
-    connectivity[1, 2, 1] = 1
-    connectivity[1, 1, 0] = 1
-    connectivity[1, 1, 2] = 1
-else:
+# cc3d supports the 6/18/26 neighbourhoods directly, no structuring element needed
+if args.connectivity not in (6, 18, 26):
     print("Invalid value for argument connectivity, exit")
     sys.exit()
 
 # Load baseline
-baseline = np.array(nib.load(args.baseline).get_fdata() == 99, dtype=float)  # Assuming Samseg segmentation 
-baseline_affine = nib.load(args.baseline).affine
+baseline_img = nib.load(args.baseline)
+# (compare the stored labels directly, get_fdata() would first cast the whole volume to float64)
+baseline = np.asarray(baseline_img.dataobj) == 99  # Assuming Samseg segmentation, kept as a boolean mask
+baseline_affine = baseline_img.affine
 # Compute voxel size
-voxelsize_baseline = np.prod(np.sum(baseline_affine[:3, :3] ** 2, axis=0) ** 0.5)
-voxel_resolution_baseline = np.sum(baseline_affine[:3, :3] ** 2, axis=0) ** 0.5
+voxel_resolution_baseline = np.linalg.norm(baseline_affine[:3, :3], axis=0)
+voxelsize_baseline = np.prod(voxel_resolution_baseline)
 # Load follow-up
-followup = np.array(nib.load(args.followup).get_fdata() == 99, dtype=float) # Assuming Samseg segmentation
+followup = np.asarray(nib.load(args.followup).dataobj) == 99  # Assuming Samseg segmentation
 # First count baseline lesions with connected components
-lesions_baseline, number_of_lesions_baseline = ndi.label(baseline, connectivity)
+lesions_baseline, number_of_lesions_baseline = cc3d.connected_components(baseline, connectivity=args.connectivity, out_dtype=np.uint32, return_N=True)
 # Remove lesions that are smaller than args.min_size
 lesion_sizes = np.bincount(lesions_baseline.ravel())[1:] * voxelsize_baseline  # remove background
 ok_sizes_baseline = lesion_sizes > args.min_size
 # 
-thresholded_baseline_lesions = int(np.sum(ok_sizes_baseline))
+thresholded_baseline_lesions = np.count_nonzero(ok_sizes_baseline)
 # Baseline volume
 baseline_volume = np.sum(lesion_sizes[ok_sizes_baseline])
 
 # Do the same for followup lesions
-lesions_followup, number_of_lesions_followup = ndi.label(followup, connectivity)
+lesions_followup, number_of_lesions_followup = cc3d.connected_components(followup, connectivity=args.connectivity, out_dtype=np.uint32, return_N=True)
 # Remove lesions that are smaller than args.min_size
 lesion_sizes = np.bincount(lesions_followup.ravel())[1:] * voxelsize_baseline  # remove background
 ok_sizes_followup = lesion_sizes > args.min_size
 # 
-thresholded_followup_lesions = int(np.sum(ok_sizes_followup))
+thresholded_followup_lesions = np.count_nonzero(ok_sizes_followup)
 # Followup volume
 followup_volume = np.sum(lesion_sizes[ok_sizes_followup])
 
-# Followup - Baseline (i.e., lesion increase)
-fu_min_bl = np.array(followup - baseline > 0, dtype=float)  
-# First count lesions with connected components
-lesions_fu_min_bl, number_of_lesions_fu_min_bl = ndi.label(fu_min_bl, connectivity)
-# Remove lesion that are smaller than args.min_size
-lesion_sizes = np.bincount(lesions_fu_min_bl.ravel())[1:] * voxelsize_baseline  # remove background
-# First discard lesions that are definitevely smaller than args.min_size
-# (avoiding removing ring shape differences which might be smaller than args.min_size but filled they are not)
-ok_sizes_fu_min_bl = lesion_sizes > 0.7 * args.min_size
-# Also compute distance_map (euclidean) to decide if new lesion has an acceptable shape
-distance_map = ndi.distance_transform_edt(lesions_fu_min_bl, sampling=voxel_resolution_baseline)
-#
-enlarging_lesions = 0
-new_lesions = 0
-for lesion_number in range(1, len(np.unique(lesions_fu_min_bl))):
-    
-    if not ok_sizes_fu_min_bl[lesion_number - 1]:
-        continue
-
-    lesion = lesions_fu_min_bl == lesion_number
-
-    volume = np.sum(lesion) * voxelsize_baseline  # Assuming same resolution for followup image
-
-    if args.debug:
-        print("Lesion: " + str(lesion_number))
-        print("Volume [mm^3]: " + str(volume))
-
-    # Check if diff lesion has an hole (i.e., it's enlarging)
-    # Right now I'm just taking the diff lesion, fill the holes and check if the enlargment is bigger than (TODO: 5%?) than the filled part
-    # TODO: not sure if it is really necessary to check for this 5% increase, although ...
-    # if we have a mislabeled voxel inside the lesion, we might classify the lesion as enlarging rather than something else
-    # Note that I'm also checking if *the filled lesion* fits the min size criteria 
-    filled = ndi.binary_fill_holes(lesion)
-    filled_volume = np.sum(filled)
-    if filled_volume - np.sum(lesion) > 0.05 * filled_volume and filled_volume > args.min_size:
-        if args.debug:
-            print("Enlarging lesion")
-        enlarging_lesions += 1 
-        continue
-
-    if volume <= args.min_size:
-        if args.debug:   
-            print("Remove lesion, too small")
-        ok_sizes_fu_min_bl[lesion_number - 1] = False
-        continue
-
-    # Finally, check if we have a new solitary lesion or a lesion abutting from another lesion:
-    # 1) has roughly a spheroid shape
-    # 2) if dilated the overlap with other lesions is small (less than args.max_overlap of its volume)
-    dilated_lesion = binary_dilation(lesion)
-    overlap = np.sum(np.logical_and(dilated_lesion, baseline) > 0)  
-    if args.debug:
-        print("Overlap: " + str(overlap))   
-    if np.max(distance_map[lesion]) > 1.1 * voxelsize_baseline and overlap < args.max_overlap * volume:
-        if args.debug:
-            print("New solitary or abutting lesion")
-        new_lesions += 1
-        continue
-
-    if args.debug:
-        print("Remove lesion, it doesn't fit criteria")
-    ok_sizes_fu_min_bl[lesion_number - 1] = False
-
+# Followup - Baseline (i.e., lesion increase) and Baseline - Followup (i.e., lesion decrease)
+# The two analyses are independent, so run them side by side
+use_gpu = GPU_AVAILABLE and not args.no_gpu
+# (share the cores between the two analyses rather than oversubscribing them)
+threads = max(1, os.cpu_count() // 2)
+with ThreadPoolExecutor(max_workers=2) as executor:
+    future_fu_min_bl = executor.submit(analyzeDiff, followup & ~baseline, baseline, voxel_resolution_baseline,
+                                       args.connectivity, args.min_size, args.max_overlap, threads, use_gpu)
+    future_bl_min_fu = executor.submit(analyzeDiff, baseline & ~followup, followup, voxel_resolution_baseline,
+                                       args.connectivity, args.min_size, args.max_overlap, threads, use_gpu)
+
+# Lesion increase: enlarging and new lesions
+lesions_fu_min_bl, number_of_lesions_fu_min_bl, lesion_sizes, candidates, enlarging, too_small, overlaps, new = future_fu_min_bl.result()
+enlarging_lesions = np.count_nonzero(enlarging)
+new_lesions = np.count_nonzero(new)
+if args.debug:
+    printClassification(candidates, lesion_sizes, enlarging, too_small, overlaps, new, "Enlarging lesion", "New solitary or abutting lesion")
+# Only keep enlarging and new lesions
+ok_sizes_fu_min_bl = enlarging | new
 # Lesion increase volume
 fu_min_bl_volume = np.sum(lesion_sizes[ok_sizes_fu_min_bl])
 
-# Baseline - Followup (i.e., lesion decrease)
-bl_min_fu = np.array(baseline - followup > 0, dtype=float)
-# First count lesions with connected components
-lesions_bl_min_fu, number_of_lesions_bl_min_fu = ndi.label(bl_min_fu, connectivity)
-# Remove lesion that are smaller than args.min_size
-lesion_sizes = np.bincount(lesions_bl_min_fu.ravel())[1:] * voxelsize_baseline  # remove background
-# First discard lesions that are definitevely smaller than args.min_size
-# (avoiding removing ring shape differences which might be smaller than args.min_size but filled they are not)
-ok_sizes_bl_min_fu = lesion_sizes > 0.7 * args.min_size
-# Also compute distance_map (euclidean) to decide if disappearing lesion has an acceptable shape
-distance_map = ndi.distance_transform_edt(lesions_bl_min_fu, sampling=voxel_resolution_baseline)
-#
-shrinking_lesions = 0
-disappearing_lesions = 0
-for lesion_number in range(1, len(np.unique(lesions_bl_min_fu))):
-    
-    if not ok_sizes_bl_min_fu[lesion_number - 1]:
-        continue
-
-    lesion = lesions_bl_min_fu == lesion_number
-
-    volume = np.sum(lesion) * voxelsize_baseline  # Assuming same resolution for followup image
-
-    if args.debug:
-        print("Lesion: " + str(lesion_number))
-        print("Volume [mm^3]: " + str(volume))
-
-    # Check if diff lesion has an hole (i.e., it's shrinking)
-    # Right now I'm just taking the diff lesion, fill the holes and check if the enlargment is bigger than (TODO: 5%?) than the filled part
-    # TODO: not sure if it is really necessary to check for this 5% increase, although
-    # if we have a mislabeled voxel inside the lesion, we might classify the lesion as shrinking rather than something else
-    # Note that I'm then checking if *the filled lesion* fits the min size criteria 
-    filled = ndi.binary_fill_holes(lesion)
-    filled_volume = np.sum(filled)
-    if filled_volume - np.sum(lesion) > 0.05 * filled_volume and filled_volume > args.min_size:
-        if args.debug:
-            print("Shrinking lesion") 
-        shrinking_lesions += 1
-        continue
-
-    if volume <= args.min_size:
-        if args.debug:
-            print("Remove lesion, too small")
-        ok_sizes_bl_min_fu[lesion_number - 1] = False
-        continue
-
-    # Finally, check if we have a disappearing lesion:
-    # 1) has roughly a spheroid shape
-    # 2) if dilated the overlap with other lesions is small (less than args.max_overlap of its volume)
-    dilated_lesion = binary_dilation(lesion)
-    overlap = np.sum(np.logical_and(dilated_lesion, followup) > 0) 
-    if args.debug:
-        print("Overlap: " + str(overlap))   
-    if np.max(distance_map[lesion]) > 1.1 * voxelsize_baseline and overlap < args.max_overlap * volume:
-        if args.debug:
-            print("Disappearing lesion")
-        disappearing_lesions += 1
-        continue
-
-    # If we are here, we are removing the lesion
-    if args.debug:     
-        print("Remove lesion, it doesn't fit criteria")
-    ok_sizes_bl_min_fu[lesion_number - 1] = False
-
+# Lesion decrease: shrinking and disappearing lesions
+lesions_bl_min_fu, number_of_lesions_bl_min_fu, lesion_sizes, candidates, shrinking, too_small, overlaps, disappearing = future_bl_min_fu.result()
+shrinking_lesions = np.count_nonzero(shrinking)
+disappearing_lesions = np.count_nonzero(disappearing)
+if args.debug:
+    printClassification(candidates, lesion_sizes, shrinking, too_small, overlaps, disappearing, "Shrinking lesion", "Disappearing lesion")
+# Only keep shrinking and disappearing lesions
+ok_sizes_bl_min_fu = shrinking | disappearing
 # Lesion decrease volume
 bl_min_fu_volume = np.sum(lesion_sizes[ok_sizes_bl_min_fu])
 
@@ -238,31 +255,36 @@ np.savez(os.path.join(args.output, "lesion_count_and_total_volume.npz"), bl_les=
 if args.save_images:        
 
     # Actually mask out small lesions
+    # (map the labels through a lookup table that sends discarded lesions to 0, one pass per image)
     # Baseline
-    for lesion_number in range(1, len(np.unique(lesions_baseline))):
-        if not ok_sizes_baseline[lesion_number - 1]:    
-            lesions_baseline[lesions_baseline == lesion_number] = 0
+    lut = np.arange(number_of_lesions_baseline + 1, dtype=lesions_baseline.dtype)
+    lut[1:][~ok_sizes_baseline] = 0
+    lesions_baseline = lut[lesions_baseline]
     # Followup
-    for lesion_number in range(1, len(np.unique(lesions_followup))):
-        if not ok_sizes_followup[lesion_number - 1]:    
-            lesions_followup[lesions_followup == lesion_number] = 0   
+    lut = np.arange(number_of_lesions_followup + 1, dtype=lesions_followup.dtype)
+    lut[1:][~ok_sizes_followup] = 0
+    lesions_followup = lut[lesions_followup]
     # fu - bl
-    for lesion_number in range(1, len(np.unique(lesions_fu_min_bl))):
-        if not ok_sizes_fu_min_bl[lesion_number - 1]:    
-            lesions_fu_min_bl[lesions_fu_min_bl == lesion_number] = 0   
+    lut = np.arange(number_of_lesions_fu_min_bl + 1, dtype=lesions_fu_min_bl.dtype)
+    lut[1:][~ok_sizes_fu_min_bl] = 0
+    lesions_fu_min_bl = lut[lesions_fu_min_bl]
     # bl - fu
-    for lesion_number in range(1, len(np.unique(lesions_bl_min_fu))):
-        if not ok_sizes_bl_min_fu[lesion_number - 1]:    
-            lesions_bl_min_fu[lesions_bl_min_fu == lesion_number] = 0                                    
+    lut = np.arange(number_of_lesions_bl_min_fu + 1, dtype=lesions_bl_min_fu.dtype)
+    lut[1:][~ok_sizes_bl_min_fu] = 0
+    lesions_bl_min_fu = lut[lesions_bl_min_fu]
 
     # Save images
-    img = nib.Nifti1Image(lesions_baseline, baseline_affine)
-    nib.save(img, os.path.join(args.output, "bl_lesions.nii.gz"))
-    img = nib.Nifti1Image(lesions_followup, baseline_affine)
-    nib.save(img, os.path.join(args.output, "fu_lesions.nii.gz"))
-    img = nib.Nifti1Image(lesions_fu_min_bl, baseline_affine)
-    nib.save(img, os.path.join(args.output, "fu_min_bl_lesions.nii.gz"))
-    img = nib.Nifti1Image(lesions_bl_min_fu, baseline_affine)
-    nib.save(img, os.path.join(args.output, "bl_min_fu_lesions.nii.gz"))
+    # (the four writes in parallel threads, zlib releases the GIL)
+    images = {"bl_lesions.nii.gz": lesions_baseline,
+              "fu_lesions.nii.gz": lesions_followup,
+              "fu_min_bl_lesions.nii.gz": lesions_fu_min_bl,
+              "bl_min_fu_lesions.nii.gz": lesions_bl_min_fu}
+    with ThreadPoolExecutor(max_workers=len(images)) as executor:
+        # int16 labels unless the lesion IDs do not fit (e.g., very noisy difference volumes)
+        futures = [executor.submit(nib.save, nib.Nifti1Image(lesions.astype(np.int16 if lesions.max() <= np.iinfo(np.int16).max else np.uint32), baseline_affine),
+                                   os.path.join(args.output, filename))
+                   for filename, lesions in images.items()]
+    for future in futures:
+        future.result()  # re-raise errors from the writes
 
 print("Done!")
@@ -3,21 +3,23 @@ import os
 from pathlib import Path
 import pandas as pd
 import re
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 ###################################################
 # define functions
 
+# compiled once, the ID getters below are called for every file
+SUBJECT_ID_PATTERN = re.compile(r'sub-m(\d{6})')
+SESSION_ID_PATTERN = re.compile(r'ses-(\d{8})')
+
 def getSubjectID(path):
     """
     :param path: path to data file
     :return: return the BIDS-compliant subject ID
     """
-    stringList = str(path).split("/")
-    indices = [i for i, s in enumerate(stringList) if 'sub-' in s]
-    text = stringList[indices[0]]
+    text = next((part for part in Path(path).parts if 'sub-' in part), '')
     try:
-        found = re.search(r'sub-m(\d{6})', text).group(1)
+        found = SUBJECT_ID_PATTERN.search(text).group(1)
     except AttributeError:
         found = ''
     return found
@@ -27,11 +29,9 @@ def getSessionID(path):
     :param path: path to data file
     :return: return the BIDS-compliant session ID
     """
-    stringList = str(path).split("/")
-    indices = [i for i, s in enumerate(stringList) if '_ses-' in s]
-    text = stringList[indices[0]]
+    text = next((part for part in Path(path).parts if '_ses-' in part), '')
     try:
-        found = re.search(r'ses-(\d{8})', text).group(1)
+        found = SESSION_ID_PATTERN.search(text).group(1)
     except AttributeError:
         found = ''
     return found
@@ -58,8 +58,8 @@ def combineStats(path, subID, sesID):
     # define path of stat files and load them as dataframe
     samseg_path = os.path.join(path, "sub-m"+subID, "ses-"+sesID, "anat", "sub-m"+subID+"_ses-"+sesID+"_samseg.stats")
     tiv_path = os.path.join(path, "sub-m"+subID, "ses-"+sesID, "anat", "sub-m"+subID+"_ses-"+sesID+"_sbtiv.stats")
-    df_samseg_stat = pd.read_csv(samseg_path, header=None, names=["ROI", "volume", "unit"])
-    df_tiv_stat = pd.read_csv(tiv_path, header=None, names=["ROI", "volume", "unit"])
+    df_samseg_stat = pd.read_csv(samseg_path, header=None, names=["ROI", "volume", "unit"], engine="c")
+    df_tiv_stat = pd.read_csv(tiv_path, header=None, names=["ROI", "volume", "unit"], engine="c")
 
     # combine _samseg and _sbtiv and clean ROI names
     df = pd.concat([df_samseg_stat, df_tiv_stat])
@@ -85,6 +85,7 @@ def combineStats(path, subID, sesID):
 parser = argparse.ArgumentParser(description='Read Volumes of SAMSEG Longitudinal Segmentation.')
 parser.add_argument('-i', '--input_directory', help='Folder of derivatives in BIDS database.', required=True)
 parser.add_argument('-o', '--output_directory', help='Destination folder for the output table with volume stats.', required=True)
+parser.add_argument('-n', '--number_of_workers', help='Number of threads reading the stats files.', type=int, default=16)
 
 # read the arguments
 args = parser.parse_args()
@@ -95,16 +96,11 @@ derivatives_dir = os.path.join(args.input_directory, "derivatives/samseg-longitu
 # get a list with the paths of the _seg.mgz files 
 # (we do this because we only want subject- and session-IDs for the cases that have been successfully segmented by SAMSEG)
 seg_list = getSegList(derivatives_dir)
-# initialize empty dataframe into which we will write the stats data of all cases
-df_stat = pd.DataFrame()
-for i in range(len(seg_list)):
-    # get subject and session ID
-    subjectID = getSubjectID(seg_list[i])
-    sessionID = getSessionID(seg_list[i])
-    # get stats of current session
-    loop_stat = combineStats(derivatives_dir, subjectID, sessionID)
-    # write stats in the final dataframe
-    df_stat = pd.concat([df_stat, loop_stat])
+# read the stats data of all cases (the files are small, so reading them in parallel threads hides the I/O latency)
+# and concatenate them once at the end
+with ThreadPoolExecutor(max_workers=args.number_of_workers) as executor:
+    stat_frames = list(executor.map(lambda seg_path: combineStats(derivatives_dir, getSubjectID(seg_path), getSessionID(seg_path)), seg_list))
+df_stat = pd.concat(stat_frames, ignore_index=True)
 
 # write stats table to .csv file in chosen output directory
 df_stat.to_csv(os.path.join(args.output_directory, "volume_stats.csv"), index=False)
@@ -113,19 +109,11 @@ df_stat.to_csv(os.path.join(args.output_directory, "volume_stats.csv"), index=Fa
 # convert the volume_stats.csv file to flattened version 
 # (e.g., the data of different timepoints of the same subject are next to each other and no more one above/below the other)
 
-# initialize empty dataframe
-df_vol1 = pd.DataFrame(columns = df_stat.columns)
-df_vol2 = pd.DataFrame(columns = df_stat.columns)
-# get all sub-IDs that ar ein the volume_stats file
-sub_ls = []
-[sub_ls.append(x) for x in list(df_stat["sub-ID"]) if x not in sub_ls]
-
-for i in range(len(sub_ls)):
-    loop_subID = sub_ls[i]
-    loop_vol = df_stat[df_stat["sub-ID"]==loop_subID]
-    # create two separate dataframes for timepoint 1 and timepoint 2
-    df_vol1 = pd.concat([df_vol1, loop_vol[loop_vol["ses-ID"]==np.min(loop_vol["ses-ID"])]])
-    df_vol2 = pd.concat([df_vol2, loop_vol[loop_vol["ses-ID"]==np.max(loop_vol["ses-ID"])]])
+# create two separate dataframes for timepoint 1 and timepoint 2
+# (first and last session of each subject, found in one pass over the table)
+ses_per_sub = df_stat.groupby("sub-ID")["ses-ID"]
+df_vol1 = df_stat[df_stat["ses-ID"]==ses_per_sub.transform("min")]
+df_vol2 = df_stat[df_stat["ses-ID"]==ses_per_sub.transform("max")]
 
 # add label of timepoint 1 or timepoint 2 to column names (keep sub-ID without label)
 df_vol1 = df_vol1.add_suffix(".t1").rename(columns={"sub-ID.t1":"sub-ID"})
@@ -10,16 +10,18 @@ def split_list(alist, splits=1):
     return [alist[i * length // splits: (i + 1) * length // splits]
             for i in range(splits)]
 
+# compiled once, the ID getters below are called for every file
+SUBJECT_ID_PATTERN = re.compile(r'sub-m(\d{6})')
+SESSION_ID_PATTERN = re.compile(r'ses-(\d{8})')
+
 def getSubjectID(path):
     """
     :param path: path to data file
     :return: return the BIDS-compliant subject ID
     """
-    stringList = str(path).split("/")
-    indices = [i for i, s in enumerate(stringList) if 'sub-' in s]
-    text = stringList[indices[0]]
+    text = next((part for part in Path(path).parts if 'sub-' in part), '')
     try:
-        found = re.search(r'sub-m(\d{6})', text).group(1)
+        found = SUBJECT_ID_PATTERN.search(text).group(1)
     except AttributeError:
         found = ''
     return found
@@ -29,11 +31,9 @@ def getSessionID(path):
     :param path: path to data file
     :return: return the BIDS-compliant session ID
     """
-    stringList = str(path).split("/")
-    indices = [i for i, s in enumerate(stringList) if '_ses-' in s]
-    text = stringList[indices[0]]
+    text = next((part for part in Path(path).parts if '_ses-' in part), '')
     try:
-        found = re.search(r'ses-(\d{8})', text).group(1)
+        found = SESSION_ID_PATTERN.search(text).group(1)
     except AttributeError:
         found = ''
     return found